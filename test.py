@@ -1,42 +1,164 @@
-import pymupdf
-import fitz
-from time import sleep
+import hashlib
+import logging
+import os
+import pickle
+import re
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
+from multiprocessing import Pool
+from operator import itemgetter
+from pathlib import Path
 
-document_filepath = knowledge_dir_files[1]
-print(f"{document_filepath = }")
+import pymupdf as fitz
+from IPython.display import Markdown, display
 
-if ".pdf" in document_filepath:
-    document_loader = PyMuPDFLoader(document_filepath)
-    pages = document_loader.load()
+logger = logging.getLogger(__name__)
 
-pages
-
-
-from IPython.display import Markdown
+N_WORKERS = min(os.cpu_count() or 1, 4)
+VERBOSE = False  # render each table with IPython.display
+TO_PANDAS = False  # also collect each table as a DataFrame in dfs
+TABLES_FILEPATH = "tables.md"
+# per-page results keyed by document digest; bump the tag whenever may_have_tables or the
+# find_tables settings change, and the PyMuPDF version is part of the path for the same reason
+CACHE_DIR = Path(".cache") / f"tables-v2-pymupdf{fitz.VersionBind}"
+PAGE_RANGE = None  # (first, stop) page indices to scan in every document, None for all pages
+TOC_PAGES_ONLY = False  # only scan pages the table of contents lists as "Table <n>", when it lists any
 
 if not hasattr(fitz.Page, "find_tables"):
     raise RuntimeError("This PyMuPDF version does not support the table feature")
+_find_tables = fitz.Page.find_tables
+_TOC_TABLE = re.compile(r"table\s+\d", re.IGNORECASE)  # "Table 3: ...", not "Table of Contents"
+
+
+def may_have_tables(page):
+    # the default "lines" strategy builds tables only from vector graphics, so no drawings means no tables
+    return bool(page.get_cdrawings())
+
+
+def page_tables(page):
+    if not may_have_tables(page):
+        return []
+    tabs = _find_tables(page).tables  # detect the tables
+    if not tabs:
+        return []
+    md_texts = [tab.to_markdown() for tab in tabs]
+    dfs = [tab.to_pandas() for tab in tabs] if TO_PANDAS else [None] * len(tabs)
+
+    # for i, tab in enumerate(tabs):
+    #     for cell in tab.header.cells:
+    #         page.draw_rect(cell,color=fitz.pdfcolor["red"],width=0.3)
+    #     page.draw_rect(tab.bbox,color=fitz.pdfcolor["green"])
+    #     print(f"Table {i} column names: \n{tab.header.names}, \nexternal: {tab.header.external}")
+    # show_image(page, f"Table & Header BBoxes")
+    return list(zip(md_texts, dfs))
+
+
+def read_cache(cache_filepath):
+    try:
+        return pickle.loads(cache_filepath.read_bytes())
+    except Exception:
+        # missing, truncated, or written by other pandas/pymupdf versions: recompute and overwrite it
+        return None
+
+
+def write_cache(cache_filepath, tables):
+    # write a temp file and rename it into place so a reader (or a second writer) never sees a partial entry
+    fd, tmp_filepath = tempfile.mkstemp(dir=cache_filepath.parent, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(tables, f)
+        os.replace(tmp_filepath, cache_filepath)
+    except BaseException:
+        os.unlink(tmp_filepath)
+        raise
+
+
+def extract_tables(batch):
+    # batch is a run of (document_filepath, digest, page_index) tasks, possibly spanning documents;
+    # open inside the worker: fitz.Document objects must not cross processes
+    cache_suffix = "-pandas.pkl" if TO_PANDAS else ".pkl"
+    documents = []
+    for (document_filepath, digest), tasks in groupby(batch, key=itemgetter(0, 1)):
+        cache_dir = CACHE_DIR / digest
+        cached = {idx: read_cache(cache_dir / f"{idx}{cache_suffix}") for _, _, idx in tasks}
+        documents.append((document_filepath, cache_dir, cached))
+    # only documents with uncached pages are read from disk at all
+    to_read = [p for p, _, cached in documents if None in cached.values()]
+
+    results = []
+    with ThreadPoolExecutor(max_workers=1) as prefetch:
+        # read the next document from disk while MuPDF is busy with the current one
+        n_read = 0
+        next_data = prefetch.submit(Path(to_read[0]).read_bytes) if to_read else None
+        for document_filepath, cache_dir, cached in documents:
+            if None in cached.values():
+                data = next_data.result()
+                n_read += 1
+                if n_read < len(to_read):
+                    next_data = prefetch.submit(Path(to_read[n_read]).read_bytes)
+
+                cache_dir.mkdir(parents=True, exist_ok=True)
+                with fitz.open(stream=data, filetype="pdf") as doc:
+                    for idx, tables in cached.items():
+                        if tables is None:
+                            cached[idx] = tables = page_tables(doc[idx])
+                            write_cache(cache_dir / f"{idx}{cache_suffix}", tables)
+
+            for idx, tables in cached.items():
+                results.extend(
+                    (document_filepath, idx, i, md_text, df) for i, (md_text, df) in enumerate(tables)
+                )
+    return results
+
+
+def candidate_pages(doc, page_range=None, toc_pages_only=None):
+    # None falls back to the module settings at call time, so they can be changed after import
+    page_range = PAGE_RANGE if page_range is None else page_range
+    toc_pages_only = TOC_PAGES_ONLY if toc_pages_only is None else toc_pages_only
+    first, stop = page_range or (0, doc.page_count)
+    pages = range(max(first, 0), min(stop, doc.page_count))
+    if toc_pages_only:
+        # toc entries are [level, title, 1-based page]; page is -1 when the entry has no target
+        toc_pages = sorted({entry[2] - 1 for entry in doc.get_toc() if _TOC_TABLE.match(entry[1])} & set(pages))
+        if toc_pages:
+            return toc_pages
+    return pages
+
+
+def batch_pages(document_filepaths, n_workers=None):
+    n_workers = n_workers or N_WORKERS
+    document_filepaths = [p for p in document_filepaths if Path(p).suffix.lower() == ".pdf"]
+
+    tasks = []
+    for document_filepath in document_filepaths:
+        # hash each document once here; workers key the page cache by this digest
+        data = Path(document_filepath).read_bytes()
+        digest = hashlib.sha256(data).hexdigest()
+        with fitz.open(stream=data, filetype="pdf") as doc:
+            tasks.extend((document_filepath, digest, i) for i in candidate_pages(doc))
+
+    size = max(1, len(tasks) // (4 * n_workers))
+    return [tasks[i : i + size] for i in range(0, len(tasks), size)]
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    dfs = []
+    n_tables = 0
+    with (
+        Pool(N_WORKERS) as pool,
+        open(TABLES_FILEPATH, "w", buffering=1 << 20, encoding="utf-8") as out,
+    ):
+        for results in pool.imap(extract_tables, batch_pages(knowledge_dir_files), chunksize=1):
+            out.write("".join([f"\n\n## {p} page {idx} table {i}\n\n{md_text}" for p, idx, i, md_text, _ in results]))
+            n_tables += len(results)
+            for document_filepath, idx, i, md_text, df in results:
+                logger.debug("file: %s page: %d table: %d", document_filepath, idx, i)
+                if VERBOSE:
+                    display(Markdown(md_text))
+                if df is not None:
+                    dfs.append((document_filepath, idx, i, df))
 
-for document_filepath in knowledge_dir_files:
-    doc = fitz.open(document_filepath)
-    # page = doc[14]
-
-    for idx, page in enumerate(doc):
-        tabs = page.find_tables()  # detect the tables
-        md_text = None
-        for i, tab in enumerate(tabs):  # iterate over all tables
-            print(f"file: {document_filepath} \npage: {idx} \ntable:{i}")
-            md_text = tab.to_markdown()
-            Markdown(md_text)
-            sleep(1)
-
-            # cur_df = tab.to_pandas()
-            # display(cur_df)
-            # for cell in tab.header.cells:
-            #     page.draw_rect(cell,color=fitz.pdfcolor["red"],width=0.3)
-            # page.draw_rect(tab.bbox,color=fitz.pdfcolor["green"])
-            # print(f"Table {i} column names: \n{tab.header.names}, \nexternal: {tab.header.external}")
-
-        # show_image(page, f"Table & Header BBoxes")
-
-tab.to_pandas()
+    logger.info("wrote %d tables to %s", n_tables, TABLES_FILEPATH)